@@ -1,6 +1,550 @@
-from typing import Callable
+from typing import Callable, Iterable, List, Tuple
+import asyncio
+import collections
+import enum
+import functools
+import logging
 import paho.mqtt.client as mqtt
-import time
+import sys
+import threading
+import uuid
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of resolved topics cached per client by default
+DEFAULT_RESOLVE_CACHE_SIZE = 1024
+
+# Maximum number of levels of a subscription filter. Incoming topics are split
+# into at most this many levels, anything deeper being kept whole in the last
+# level, bounding the work done for pathological topics
+MAX_TOPIC_DEPTH = 32
+
+# A birth or will message, in the argument order of paho's publish and will_set
+Message = collections.namedtuple('Message', 'topic payload qos retain')
+
+
+class LoopMode(enum.Enum):
+    ''' How the network loop of a client is run '''
+    # In a background thread started by paho
+    THREAD = 'thread'
+    # In the calling thread, connect(...) blocks until disconnected
+    BLOCK = 'block'
+    # On the running asyncio event loop, without any extra thread
+    ASYNCIO = 'asyncio'
+
+
+# Optional birth and will message keys, with their defaults
+_MESSAGE_DEFAULTS = (('payload', None), ('qos', 0), ('retain', False))
+
+# Key under which a subscription trie node stores its (callbacks, qos) pair
+_LEAF = '__leaf__'
+
+
+def get_mac_address():
+    ''' Get the MAC address of this machine, e.g. for use as a client ID '''
+    mac = '%012x' % uuid.getnode()
+    return ':'.join(mac[i:i + 2] for i in range(0, 12, 2))
+
+
+def _fill_message(message: dict, name: str, default: Message):
+    ''' Validate a birth or will message dict and freeze it into a Message,
+    using default if no message was given
+    '''
+    if not message:
+        return default
+    if 'topic' not in message:
+        raise AttributeError(f'{name} must have "topic" key')
+    return Message(
+        message['topic'],
+        *(message.get(key, value) for key, value in _MESSAGE_DEFAULTS)
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_topic(topic: str, max_depth: int = MAX_TOPIC_DEPTH):
+    ''' Split a topic into at most max_depth levels. Cached as hot topics
+    repeat often, and levels are interned so trie lookups compare by identity
+    '''
+    return tuple(
+        sys.intern(level) for level in topic.split('/', max_depth - 1))
+
+
+def _validate_filter(topic: str):
+    ''' Raise ValueError if topic is not a valid subscription filter '''
+    if not topic:
+        raise ValueError('Topic filter must not be empty')
+    levels = topic.split('/')
+    if len(levels) > MAX_TOPIC_DEPTH:
+        raise ValueError(
+            f'Topic filter deeper than {MAX_TOPIC_DEPTH} levels: "{topic}"')
+    for index, level in enumerate(levels):
+        if ('+' in level or '#' in level) and len(level) > 1:
+            raise ValueError(
+                f'Wildcards must be a whole topic level: "{topic}"')
+        if level == '#' and index != len(levels) - 1:
+            raise ValueError(f'"#" must be the last topic level: "{topic}"')
+
+
+def _validate_qos(qos: int):
+    ''' Raise ValueError if qos is not a valid QoS level '''
+    if qos not in (0, 1, 2):
+        raise ValueError(f'QoS must be 0, 1 or 2, not {qos}')
+
+
+def _match_topic(node: dict, levels: tuple, depth: int = 0):
+    ''' Collect the (callbacks, qos) pairs of all subscriptions in the trie
+    below node whose filters match the topic levels from depth onwards
+    '''
+    matches = []
+    # Wildcards must not match topics starting with '$' (e.g. $SYS)
+    wildcards = depth or not levels[0].startswith('$')
+
+    # '#' matches the parent level and everything below it
+    multi_level = node.get('#') if wildcards else None
+    if multi_level is not None and _LEAF in multi_level:
+        matches.append(multi_level[_LEAF])
+
+    if depth == len(levels):
+        if _LEAF in node:
+            matches.append(node[_LEAF])
+        return matches
+
+    child = node.get(levels[depth])
+    if child is not None:
+        matches.extend(_match_topic(child, levels, depth + 1))
+
+    # '+' matches a single level, not the remainder of a truncated topic
+    child = node.get('+') if wildcards else None
+    if child is not None and '/' not in levels[depth]:
+        matches.extend(_match_topic(child, levels, depth + 1))
+
+    return matches
+
+
+def _trie_leaf(trie: dict, levels: tuple):
+    ''' Get the leaf stored under levels, or None if there is none '''
+    node = trie
+    for level in levels:
+        node = node.get(level)
+        if node is None:
+            return None
+    return node.get(_LEAF)
+
+
+def _trie_insert(trie: dict, levels: tuple, leaf: tuple):
+    ''' Get a copy of trie with leaf stored under levels. Only the nodes along
+    the path are copied, the rest are shared with trie
+    '''
+    root = node = dict(trie)
+    for level in levels:
+        child = dict(node.get(level, {}))
+        node[level] = child
+        node = child
+    node[_LEAF] = leaf
+    return root
+
+
+def _trie_remove(trie: dict, levels: tuple):
+    ''' Get a copy of trie without the leaf stored under levels, pruning any
+    nodes left empty. Returns None if there is no such leaf
+    '''
+    path = [trie]
+    for level in levels:
+        node = path[-1].get(level)
+        if node is None:
+            return None
+        path.append(node)
+
+    if _LEAF not in path[-1]:
+        return None
+
+    # Rebuild the path bottom up, dropping the leaf and emptied nodes
+    node = {key: child for key, child in path[-1].items() if key != _LEAF}
+    for parent, level in zip(reversed(path[:-1]), reversed(levels)):
+        parent = dict(parent)
+        if node:
+            parent[level] = node
+        else:
+            del parent[level]
+        node = parent
+    return node
+
+
+def _enqueue(queue: collections.deque, ready, callbacks: tuple, message):
+    ''' Queue a message for a client's worker, waking it with ready, a
+    threading.Event or an asyncio.Event. The deque drops the oldest message
+    when full
+    '''
+    queue.append((callbacks, message))
+    ready.set()
+
+
+def _run_queued(queue: collections.deque):
+    ''' Run the callbacks of queued messages. Returns False once the
+    sentinel queued by MqttClient.disconnect is reached
+    '''
+    while queue:
+        callbacks, message = queue.popleft()
+        if callbacks is None:
+            return False
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception:
+                _LOGGER.exception(
+                    'Error in callback for topic %s', message.topic)
+    return True
+
+
+def _drain_queue(queue: collections.deque, ready: threading.Event):
+    ''' Run queued callbacks on a worker thread until disconnected '''
+    while True:
+        ready.wait()
+        ready.clear()
+        if not _run_queued(queue):
+            return
+
+
+async def _drain_queue_async(queue: collections.deque, ready: asyncio.Event):
+    ''' Run queued callbacks in a task on the event loop until disconnected
+    '''
+    while True:
+        await ready.wait()
+        ready.clear()
+        if not _run_queued(queue):
+            return
+
+
+# Connections shared between MqttClients, keyed by
+# (broker_host, broker_port, username, client_id)
+_CLIENT_POOL = {}
+
+# Seconds to wait before reconnecting in asyncio mode, doubling on each failure
+_RECONNECT_DELAY_MIN = 1
+_RECONNECT_DELAY_MAX = 120
+
+# Connection settings MqttClients must agree on to share a connection
+_SHARED_SETTINGS = ('password', 'will_message', 'max_inflight', 'loop_mode')
+_CLIENT_POOL_LOCK = threading.Lock()
+
+
+class _SharedClient:
+    ''' A paho client, its socket and its network loop, shared by all of the
+    MqttClients connecting to the same broker as the same user and client ID.
+    The connection is configured by the first MqttClient to acquire it and
+    torn down when the last one releases it. Later MqttClients must use the
+    same _SHARED_SETTINGS.
+    '''
+    def __init__(self, key, owner):
+        self._key = key
+        self._settings = {
+            name: getattr(owner, name) for name in _SHARED_SETTINGS}
+        self._host = owner.broker_host
+        self._port = owner.broker_port
+        self.loop_mode = owner.loop_mode
+
+        self._lock = threading.Lock()
+        # Held from deciding on a SUBSCRIBE or UNSUBSCRIBE until it is sent,
+        # so packets reach the broker in the order _subscribers changed.
+        # Never taken by _on_disconnect, and reentrant for callbacks
+        # subscribing from within a send
+        self._send_lock = threading.RLock()
+        self._listeners = ()
+        # Topic -> {MqttClient: qos} of the listeners subscribed to it. The
+        # connection is subscribed to each topic at the highest of these
+        self._subscribers = {}
+        # Arguments of the last on_connect, replayed to late listeners
+        self._connect_args = None
+        # Set once the last listener is released, to stop reconnecting
+        self._closing = False
+
+        self.client = mqtt.Client(
+            client_id=owner.client_id
+        )
+
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+
+        if owner.will_message:
+            self.client.will_set(*owner.will_message)
+
+        if owner.username:
+            self.client.username_pw_set(
+                username=owner.username,
+                password=owner.password
+            )
+
+        if owner.max_inflight is not None:
+            self.client.max_inflight_messages_set(owner.max_inflight)
+
+        if self.loop_mode is LoopMode.ASYNCIO:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Not called from a coroutine, nothing to integrate with
+                self.loop_mode = LoopMode.THREAD
+            else:
+                self._misc_handle = None
+                self._reconnect_handle = None
+                self._reconnect_delay = _RECONNECT_DELAY_MIN
+                self.client.on_socket_open = self._on_socket_open
+                self.client.on_socket_close = self._on_socket_close
+                self.client.on_socket_register_write = \
+                    self._on_socket_register_write
+                self.client.on_socket_unregister_write = \
+                    self._on_socket_unregister_write
+
+    @classmethod
+    def acquire(cls, listener):
+        ''' Get the shared client for listener's broker profile and attach
+        listener to it, connecting to the broker if it is the first
+        '''
+        key = (listener.broker_host, listener.broker_port,
+               listener.username, listener.client_id)
+
+        with _CLIENT_POOL_LOCK:
+            shared = _CLIENT_POOL.get(key)
+            if shared is None:
+                shared = _CLIENT_POOL[key] = cls(key, listener)
+            else:
+                mismatched = [
+                    name for name, value in shared._settings.items()
+                    if getattr(listener, name) != value]
+                if mismatched:
+                    raise ValueError(
+                        'Another client is already connected with the same '
+                        'broker, username and client ID but a different '
+                        + ', '.join(mismatched))
+
+            # Hand the client over before any callback can reach the listener
+            listener._shared = shared
+            listener._client = shared.client
+
+            with shared._lock:
+                shared._listeners += (listener,)
+                first = len(shared._listeners) == 1
+                connect_args = shared._connect_args
+
+        if first:
+            try:
+                shared.client.connect(
+                    host=shared._host,
+                    port=shared._port
+                )
+            except Exception:
+                listener.disconnect()
+                raise
+
+            # In asyncio mode the socket callbacks have hooked paho into the
+            # event loop during connect
+            if shared.loop_mode is LoopMode.THREAD:
+                shared.client.loop_start()
+            elif shared.loop_mode is LoopMode.BLOCK:
+                shared.client.loop_forever()
+        elif connect_args:
+            listener._on_connect(*connect_args)
+
+        return shared
+
+    def release(self, listener):
+        ''' Detach listener, disconnecting from the broker if it was the
+        last one attached
+        '''
+        with self._send_lock:
+            with _CLIENT_POOL_LOCK, self._lock:
+                if listener not in self._listeners:
+                    return
+                self._listeners = tuple(
+                    l for l in self._listeners if l is not listener)
+                last = not self._listeners
+                if last:
+                    del _CLIENT_POOL[self._key]
+                    self._closing = True
+
+                # Drop the listener's subscriptions, noting the ones nobody
+                # else needs and the ones others need at a lower QoS
+                orphaned = []
+                downgraded = []
+                for topic in list(self._subscribers):
+                    wire_qos = self._drop_subscriber(listener, topic)
+                    if wire_qos is None:
+                        orphaned.append(topic)
+                    elif wire_qos >= 0:
+                        downgraded.append((topic, wire_qos))
+
+            if not last:
+                if orphaned:
+                    self.client.unsubscribe(orphaned)
+                if downgraded:
+                    self.client.subscribe(downgraded)
+
+        if last:
+            if self.loop_mode is LoopMode.ASYNCIO and self._reconnect_handle:
+                self._reconnect_handle.cancel()
+            self.client.loop_stop()
+            self.client.disconnect()
+
+        if listener.connected:
+            listener._on_disconnect(self.client, None, mqtt.MQTT_ERR_SUCCESS)
+
+    def subscribe(self, listener, subs: list):
+        ''' Subscribe listener to a list of (topic, qos) pairs on the shared
+        connection. Only topics whose highest QoS across listeners rises are
+        sent, using a single SUBSCRIBE packet
+        '''
+        with self._send_lock:
+            with self._lock:
+                # Subscribers of each topic before this call, to roll back to
+                previous = {}
+                wire_subs = []
+                for topic, qos in subs:
+                    subscribers = self._subscribers.setdefault(topic, {})
+                    previous.setdefault(topic, dict(subscribers))
+                    wire_qos = max(subscribers.values(), default=-1)
+                    subscribers[listener] = qos
+                    if qos > wire_qos:
+                        wire_subs.append((topic, qos))
+
+            if not wire_subs:
+                return
+
+            try:
+                result, _mid = self.client.subscribe(wire_subs)
+                if result != mqtt.MQTT_ERR_SUCCESS:
+                    raise ConnectionError(
+                        f'Failed to subscribe: {mqtt.error_string(result)}')
+            except Exception:
+                with self._lock:
+                    for topic, subscribers in previous.items():
+                        if subscribers:
+                            self._subscribers[topic] = subscribers
+                        else:
+                            self._subscribers.pop(topic, None)
+                raise
+
+    def unsubscribe(self, listener, topic: str):
+        ''' Unsubscribe listener from topic, only unsubscribing the shared
+        connection once no other listener needs the topic, and otherwise
+        lowering its QoS to the highest still needed
+        '''
+        with self._send_lock:
+            with self._lock:
+                wire_qos = self._drop_subscriber(listener, topic)
+
+            if wire_qos is None:
+                self.client.unsubscribe(topic)
+            elif wire_qos >= 0:
+                self.client.subscribe(topic, wire_qos)
+
+    def _drop_subscriber(self, listener, topic: str):
+        ''' Remove listener from the subscribers of topic. Must be called with
+        the lock held.
+
+        Returns:
+            None if the connection should unsubscribe from topic, the QoS to
+            resubscribe at if it should be lowered, or -1 if nothing changes.
+        '''
+        subscribers = self._subscribers.get(topic)
+        if not subscribers or listener not in subscribers:
+            return -1
+
+        wire_qos = max(subscribers.values())
+        del subscribers[listener]
+        if not subscribers:
+            del self._subscribers[topic]
+            return None
+
+        remaining_qos = max(subscribers.values())
+        return remaining_qos if remaining_qos < wire_qos else -1
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_handle = self._loop.call_soon(self._loop_misc)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        if self._misc_handle:
+            self._misc_handle.cancel()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _loop_misc(self):
+        ''' Handle keepalives and retries every second, as paho's own loop
+        does, for as long as the connection is up
+        '''
+        if self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            self._misc_handle = self._loop.call_later(1, self._loop_misc)
+
+    def _schedule_reconnect(self):
+        ''' Reconnect after a delay, backing off exponentially. Without a loop
+        thread nothing else would ever reconnect in asyncio mode
+        '''
+        self._reconnect_handle = self._loop.call_later(
+            self._reconnect_delay, self._reconnect)
+        self._reconnect_delay = min(
+            self._reconnect_delay * 2, _RECONNECT_DELAY_MAX)
+
+    def _reconnect(self):
+        self._reconnect_handle = None
+        if self._closing:
+            return
+        try:
+            # The socket callbacks hook the new socket into the event loop
+            self.client.reconnect()
+        except OSError:
+            self._schedule_reconnect()
+
+    def _on_message(self, client, userdata, message):
+        # Dispatch straight into each listener's resolved callbacks, interning
+        # the topic once however many listeners share the connection.
+        # Listeners without subscriptions are skipped with a single test.
+        # A failing callback is logged, as raising would skip the remaining
+        # callbacks and stop paho's loop for every listener
+        topic = sys.intern(message.topic)
+        for listener in self._listeners:
+            if listener._sub_trie:
+                for callback in listener._resolve_cache(topic):
+                    try:
+                        callback(message)
+                    except Exception:
+                        _LOGGER.exception(
+                            'Error in callback for topic %s', topic)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        with self._send_lock:
+            with self._lock:
+                self._connect_args = (client, userdata, flags, rc)
+                listeners = self._listeners
+                resubscribe = [
+                    (topic, max(subscribers.values()))
+                    for topic, subscribers in self._subscribers.items()]
+
+            # A clean session has forgotten the subscriptions of a lost
+            # connection, so restore them in one packet on reconnecting
+            if resubscribe and rc == mqtt.CONNACK_ACCEPTED:
+                client.subscribe(resubscribe)
+
+        if self.loop_mode is LoopMode.ASYNCIO:
+            self._reconnect_delay = _RECONNECT_DELAY_MIN
+        for listener in listeners:
+            listener._on_connect(client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connect_args = None
+            listeners = self._listeners
+        for listener in listeners:
+            listener._on_disconnect(client, userdata, rc)
+
+        if (self.loop_mode is LoopMode.ASYNCIO and not self._closing
+                and self._reconnect_handle is None):
+            self._schedule_reconnect()
+
 
 class MqttClient:
     ''' Listen to a given topic on an MQTT network and run a callback on recive
@@ -18,8 +562,12 @@ class MqttClient:
         broker_port (int, optional): Connection port of MQTT broker server.
             Default is 1883 (default unsecured MQTT port)
         client_id (:obj:`str`, optional): An ID string to be used by the client
-            when connecting to the broker. By default the MAC address of the
-            machine will be used.
+            when connecting to the broker. By default paho generates a random
+            ID. get_mac_address() can be used to identify the machine instead.
+            Clients with the same broker, username and client ID share one
+            connection, so must also have the same password, will_message,
+            max_inflight and loop_mode. connect(...) raises ValueError
+            otherwise.
         birth_message (dict, optional): A dict containing parameters for the client's
             birth message. This message is sent by the client upon connection.
             birth_message = {
@@ -57,14 +605,55 @@ class MqttClient:
             }
         threaded (bool, optional): Should the listener run in a separate
             thread? If false, connect(...) method is a blocking call.
-            Default is True
+            Default is True. Ignored if loop_mode is given.
+        loop_mode (:obj:`LoopMode` or :obj:`str`, optional): How to run the
+            network loop, one of 'thread', 'block' or 'asyncio'. In 'asyncio'
+            mode connect(...) must be called from a coroutine, does not wait
+            for the connection (use on_connect), and the client must only be
+            used from the event loop's thread. Lost connections are retried
+            with exponential backoff, and resubscribed once reconnected. Falls back to 'thread' if no event loop
+            is running. Defaults to 'thread', or 'block' if
+            threaded is False.
+        max_inflight (int, optional): Maximum number of QoS 1 and 2 messages
+            that can be in flight at once. Raise this so batches sent with
+            publish_many(...) are pipelined rather than waiting on
+            acknowledgements. Default is paho's (20).
+        queue_size (int, optional): If above 0, received messages are queued
+            and callbacks run on a separate worker thread, or in asyncio mode
+            a task on the event loop, so slow callbacks cannot stall the
+            network loop. Once queue_size messages are
+            waiting the oldest are dropped. Default is 0 (no queue, callbacks
+            run on the network loop).
     '''
+    __slots__ = (
+        'on_connect', 'on_disconnect', 'broker_host', 'broker_port',
+        'client_id', 'username', 'password', 'birth_message', 'will_message',
+        'loop_mode', 'max_inflight', '_sub_trie', '_subscribe_lock',
+        '_pending_subs', '_resolve_cache', '_resolve_cache_size',
+        '_connected', '_connected_event', '_shared', '_client',
+        '_publish_impl', '_queue_size', '_queue', '_queue_ready',
+        '_queue_worker'
+    )
+
     def __init__(self, on_connect=None, on_disconnect=None,
                  broker_host=None, broker_port=None, client_id=None,
                  username=None, password=None,
-                 birth_message=None, will_message=None, threaded=None):
-
-        self._subscribe_topics = {}
+                 birth_message=None, will_message=None, threaded=None,
+                 loop_mode=None, max_inflight=None, queue_size=0):
+
+        # Subscription trie, one dict per topic level. Never modified in
+        # place: writers swap in an updated copy so readers need no lock
+        self._sub_trie = {}
+        self._subscribe_lock = threading.RLock()
+        # (topic, callback, qos) subscriptions waiting for flush_subscriptions
+        self._pending_subs = []
+        # Messages waiting for the worker thread or task, as
+        # (callbacks, message). Each connection gets its own queue and worker
+        self._queue_size = queue_size
+        self._queue = None
+        self._queue_ready = None
+        self._queue_worker = None
+        self.with_cache(DEFAULT_RESOLVE_CACHE_SIZE)
 
         if on_connect:
             assert callable(on_connect)
@@ -74,8 +663,8 @@ class MqttClient:
             assert callable(on_disconnect)
         self.on_disconnect = on_disconnect
 
-        self.broker_host = broker_host or '127.0.0.1'
-        self.broker_port = broker_port or 1883
+        self.broker_host = '127.0.0.1' if broker_host is None else broker_host
+        self.broker_port = 1883 if broker_port is None else broker_port
         self.client_id = client_id
 
         if (password and not username):
@@ -85,73 +674,94 @@ class MqttClient:
         self.username = username
         self.password = password
 
-        # Set birth message
-        if birth_message:
-            if 'topic' not in birth_message:
-                raise AttributeError('birth_message must have "topic" key')
-            if 'payload' not in birth_message:
-                birth_message['payload'] = None
-            if 'qos' not in birth_message:
-                birth_message['qos'] = 0
-            if 'retain' not in birth_message:
-                birth_message['retain'] = False
-
-        if not birth_message:
-            birth_message = {
-                'topic': f'clients/{self.client_id}/connected',
-                'payload': '1',
-                'qos': 1,
-                'retain': True
-            }
+        # Set birth and will messages, defaulting to connection status
+        status_topic = f'clients/{self.client_id}/connected'
+        self.birth_message = _fill_message(
+            birth_message, 'birth_message', Message(status_topic, '1', 1, True))
+        self.will_message = _fill_message(
+            will_message, 'will_message', Message(status_topic, '0', 1, True))
 
-        self.birth_message = birth_message
-
-        # Set will message
-        if will_message:
-            if 'topic' not in will_message:
-                raise AttributeError('will_message must have "topic" key')
-            if 'payload' not in will_message:
-                will_message['payload'] = None
-            if 'qos' not in will_message:
-                will_message['qos'] = 0
-            if 'retain' not in will_message:
-                will_message['retain'] = False
-
-        if not will_message:
-            will_message = {
-                'topic': f'clients/{self.client_id}/connected',
-                'payload': '0',
-                'qos': 1,
-                'retain': True
-            }
-
-        self.will_message = will_message
-
-        self.threaded = threaded or True
+        if loop_mode is None:
+            threaded = True if threaded is None else threaded
+            loop_mode = LoopMode.THREAD if threaded else LoopMode.BLOCK
+        self.loop_mode = LoopMode(loop_mode)
+        self.max_inflight = max_inflight
 
         self._connected = False
+        self._connected_event = threading.Event()
 
-        # MQTT client
+        # MQTT client, shared with other MqttClients using the same broker
+        self._shared = None
         self._client = None
+        self._publish_impl = self._publish_connecting
 
     @property
     def connected(self):
         ''' Is client connected to MQTT broker? '''
         return self._connected
 
+    @property
+    def threaded(self):
+        ''' Does the network loop run in a separate thread? '''
+        return self.loop_mode is LoopMode.THREAD
+
+    def with_cache(self, capacity: int):
+        '''Set how many topics to cache the resolved callbacks of.
+
+        Args:
+            * capacity (int): Maximum number of cached topics. Use 0 to
+                disable caching on memory constrained devices.
+
+        Returns:
+            MqttClient: This client, to allow chaining.
+        '''
+        self._resolve_cache_size = capacity
+        self._reset_resolve_cache()
+        return self
+
+    def _reset_resolve_cache(self):
+        ''' Replace the resolve cache with an empty one. It is replaced rather
+        than cleared so that a lookup racing with a subscription change can
+        only populate the discarded cache
+        '''
+        resolve = self._resolve_topic
+        if self._queue_size:
+            resolve = self._resolve_topic_queued
+        self._resolve_cache = functools.lru_cache(
+            maxsize=self._resolve_cache_size)(resolve)
+
     def connect(self):
         ''' Connect to MQTT broker and start publishing sensor values '''
-        if not self._connected:
+        # Once attached, lost connections are reconnected automatically, by
+        # paho's loop or, in asyncio mode, by the shared client
+        if self._shared is None:
             self._start_client()
 
     def disconnect(self):
         ''' Disconnect from MQTT broker and stop reading sensor '''
-        if self._client:
-            self._client.loop_stop()
-            self._client.disconnect()
+        if self._shared:
+            self._shared.release(self)
+        self._shared = None
         self._client = None
-
-    def subscribe(self, topic: str, callback: Callable[[str], None], qos: int = 0):
+        self._publish_impl = self._publish_connecting
+        self._connected_event.clear()
+        # The connection's subscriptions have been dropped, and cached
+        # callbacks are bound to the old client
+        with self._subscribe_lock:
+            self._sub_trie = {}
+            self._reset_resolve_cache()
+
+        # Stop the worker once it has run the callbacks already queued. A new
+        # connection starts a worker with a queue of its own
+        if self._queue_worker:
+            self._queue.append((None, None))
+            self._queue_ready.set()
+            self._queue = None
+            self._queue_ready = None
+            self._queue_worker = None
+
+    def subscribe(self, topic: str, callback: Callable[[str], None], qos: int = 0,
+                  defer: bool = False):
         '''Listen to a topic and call the callback with any messages received.
 
         Args:
@@ -162,85 +772,245 @@ class MqttClient:
                 recieved from the MQTT broker on the subscribed topic.
             >>> def my_callback(client, userdata, message):
                 ...
+            * defer (bool): Buffer the subscription until flush_subscriptions
+                is called, so that many subscriptions share one packet.
         '''
-        self._client.subscribe(topic, qos)
-        self._subscribe_topics[topic] = callback
+        if defer:
+            # Validated now, as one invalid subscription fails the whole flush
+            _validate_filter(topic)
+            _validate_qos(qos)
+            with self._subscribe_lock:
+                self._pending_subs.append((topic, callback, qos))
+        else:
+            self.subscribe_many([(topic, callback, qos)])
 
-    def unsubscribe(self, topic: str):
-        '''Listen to a topic and call the callback with any messages received'''
-        if topic in self._subscribe_topics:
-            self._client.unsubscribe(topic)
-            del self._subscribe_topics[topic]
+    def subscribe_many(self, subs: List[Tuple[str, Callable, int]]):
+        '''Listen to several topics at once, sending a single SUBSCRIBE packet.
 
-    def publish(self, topic: str, message: str):
-        '''Publish a message to a topic. Connects to client if not connected'''
-        if not self._connected:
-            self.connect()
-        self._client.publish(topic, message)
+        Args:
+            * subs (list): (topic, callback, qos) tuples, as would be passed
+                to subscribe.
+
+        Raises:
+            ValueError: If a topic is not a valid filter, e.g. 'a/#/b', or
+                is deeper than MAX_TOPIC_DEPTH levels, or a QoS is invalid.
+            ConnectionError: If the client is not connected, or the
+                subscription could not be sent.
+        '''
+        if not subs:
+            return
+
+        for topic, _callback, qos in subs:
+            _validate_filter(topic)
+            _validate_qos(qos)
+
+        if self._shared is None:
+            raise ConnectionError('Must be connected to subscribe')
+
+        subs = [(sys.intern(topic), callback, qos) for topic, callback, qos in subs]
+        with self._subscribe_lock:
+            trie = self._sub_trie
+            # Only new topics, or ones needing a higher QoS, go on the wire
+            wire_subs = []
+            for topic, callback, qos in subs:
+                levels = _split_topic(topic)
+                leaf = _trie_leaf(trie, levels)
+                if leaf is None:
+                    wire_subs.append((topic, qos))
+                    leaf = ((callback,), qos)
+                else:
+                    callbacks, subscribed_qos = leaf
+                    if qos > subscribed_qos:
+                        wire_subs.append((topic, qos))
+                    leaf = (callbacks + (callback,), max(qos, subscribed_qos))
+                trie = _trie_insert(trie, levels, leaf)
+
+            # Install the new trie first so no message arriving after the
+            # SUBACK is missed, and roll it back if subscribing fails
+            previous_trie = self._sub_trie
+            self._sub_trie = trie
+            self._reset_resolve_cache()
+            if wire_subs:
+                try:
+                    self._shared.subscribe(self, wire_subs)
+                except Exception:
+                    self._sub_trie = previous_trie
+                    self._reset_resolve_cache()
+                    raise
+
+    def flush_subscriptions(self):
+        '''Send all subscriptions deferred by subscribe in one packet'''
+        with self._subscribe_lock:
+            pending, self._pending_subs = self._pending_subs, []
+            try:
+                self.subscribe_many(pending)
+            except Exception:
+                # Keep them pending so the flush can be retried
+                self._pending_subs = pending + self._pending_subs
+                raise
+
+    def unsubscribe(self, topic: str, callback: Callable = None):
+        '''Stop listening to a topic previously subscribed to.
 
-    def _start_client(self):
-        self._client = mqtt.Client(
-            client_id=self.client_id
-        )
+        Args:
+            * topic (:obj:`str`): Topic branch to unsubscribe from.
+            * callback (function, optional): Only remove this callback from
+                the topic. By default all of the topic's callbacks are removed.
+                The topic is only unsubscribed from once it has no callbacks.
+        '''
+        with self._subscribe_lock:
+            levels = _split_topic(topic)
+            leaf = _trie_leaf(self._sub_trie, levels)
+            if leaf is None:
+                return
+
+            callbacks, qos = leaf
+            if callback is None:
+                callbacks = ()
+            elif callback in callbacks:
+                index = callbacks.index(callback)
+                callbacks = callbacks[:index] + callbacks[index + 1:]
+            else:
+                return
+
+            if callbacks:
+                self._sub_trie = _trie_insert(
+                    self._sub_trie, levels, (callbacks, qos))
+                self._reset_resolve_cache()
+                return
+
+            self._sub_trie = _trie_remove(self._sub_trie, levels)
+            self._reset_resolve_cache()
+            self._shared.unsubscribe(self, topic)
+
+    def publish(self, topic: str, message: str, qos: int = 0,
+                retain: bool = False):
+        '''Publish a message to a topic. Connects to client if not connected.
 
-        self._client.on_connect = self._on_connect
-        self._client.on_disconnect = self._on_disconnect
-        self._client.on_message = self._on_message
+        Args:
+            * topic (:obj:`str`): Topic to publish the message to.
+            * message (:obj:`str`): Payload of the message.
+            * qos (int): QoS value to use. Should be 0, 1, or 2. Higher values
+                cost more packets per message.
+            * retain (bool): Should the broker keep the message as the last
+                known value of the topic?
+
+        Raises:
+            ConnectionError: If a blocking connect(...) was disconnected
+                before returning.
+        '''
+        self._publish_impl(topic, message, qos, retain)
 
-        if self.will_message:
-            self._client.will_set(
-                topic=self.will_message['topic'],
-                payload=self.will_message['payload'],
-                qos=self.will_message['qos'],
-                retain=self.will_message['retain']
-            )
+    def publish_many(self, messages: Iterable[Tuple[str, str, int, bool]]):
+        '''Publish several messages. Connects to client if not connected.
 
-        if self.username:
-            self._client.username_pw_set(
-                username=self.username,
-                password=self.password
-            )
-
-        self._client.connect(
-            host=self.broker_host,
-            port=self.broker_port
-        )
+        Args:
+            * messages (iterable): (topic, payload, qos, retain) tuples. qos
+                and retain are optional, as for publish.
 
-        if self.threaded:
-            self._client.loop_start()
-        else:
-            self._client.loop_forever()
+        Raises:
+            ConnectionError: If a blocking connect(...) was disconnected
+                before returning.
+        '''
+        publish = self._connect_for_publish().publish
+        for message in messages:
+            publish(*message)
+
+    def _publish_connecting(self, topic: str, message: str, qos: int = 0,
+                            retain: bool = False):
+        ''' Publish used until connected, after which paho's publish is used
+        directly
+        '''
+        self._publish_impl = self._connect_for_publish().publish
+        self._publish_impl(topic, message, qos, retain)
 
-        # Spin until connected
-        timeout = 5
-        seconds_passed = 0
-        while not self.connected:
-            if seconds_passed > timeout:
-                raise ConnectionError('Timeout waiting to connect to MQTT broker')
-            time.sleep(0.1)
-            seconds_passed += 0.1
+    def _connect_for_publish(self):
+        ''' Connect if not connected and get the paho client to publish with
+        '''
+        self.connect()
+        # A blocking connect(...) only returns once the loop has ended, by
+        # which time the client may have been disconnected
+        if self._client is None:
+            raise ConnectionError('Disconnected before publishing')
+        return self._client
 
-    def _on_message(self, client, userdata, message):
-        if message.topic in self._subscribe_topics:
-            self._subscribe_topics[message.topic](client, userdata, message)
+    def _start_client(self):
+        if self._queue_size:
+            self._queue = collections.deque(maxlen=self._queue_size)
+            self._reset_resolve_cache()
+            self._start_queue_worker()
+
+        try:
+            shared = _SharedClient.acquire(self)
+        except Exception:
+            self.disconnect()
+            raise
+
+        # Wait until connected. A blocking loop only returns once disconnected,
+        # and an asyncio loop needs this thread to make the connection
+        if (shared.loop_mode is LoopMode.THREAD
+                and not self._connected_event.wait(timeout=5)):
+            raise ConnectionError('Timeout waiting to connect to MQTT broker')
+
+    def _start_queue_worker(self):
+        ''' Start running queued callbacks. In asyncio mode they run in a
+        task on the event loop, as the client must only be used from the
+        loop's thread. As for the network loop, a thread is used instead if
+        no event loop is running
+        '''
+        loop = None
+        if self.loop_mode is LoopMode.ASYNCIO:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+
+        if loop:
+            self._queue_ready = asyncio.Event()
+            self._queue_worker = loop.create_task(
+                _drain_queue_async(self._queue, self._queue_ready))
+        else:
+            self._queue_ready = threading.Event()
+            self._queue_worker = threading.Thread(
+                target=_drain_queue, args=(self._queue, self._queue_ready),
+                daemon=True)
+            self._queue_worker.start()
+
+    def _resolve_topic(self, topic: str):
+        ''' Get the callbacks of all subscriptions matching topic, with the
+        client and userdata arguments already bound. The client never sets
+        userdata, so paho always passes None
+        '''
+        levels = _split_topic(topic)
+        return tuple(
+            functools.partial(callback, self._client, None)
+            for callbacks, _qos in _match_topic(self._sub_trie, levels)
+            for callback in callbacks)
+
+    def _resolve_topic_queued(self, topic: str):
+        ''' Get a single callback queueing messages on topic for the worker,
+        which runs the callbacks of all subscriptions matching topic
+        '''
+        callbacks = self._resolve_topic(topic)
+        if not callbacks or self._queue is None:
+            return ()
+        return (functools.partial(
+            _enqueue, self._queue, self._queue_ready, callbacks),)
 
-    def _on_connect(self, *args, **kwargs):
+    def _on_connect(self, client, userdata, flags, rc):
         self._connected = True
+        self._connected_event.set()
 
         # Publish birth message
         if self.birth_message:
-            self._client.publish(
-                topic=self.birth_message['topic'],
-                payload=self.birth_message['payload'],
-                qos=self.birth_message['qos'],
-                retain=self.birth_message['retain']
-            )
+            self._client.publish(*self.birth_message)
 
         if self.on_connect:
-            self.on_connect(*args, **kwargs)
+            self.on_connect(client, userdata, flags, rc)
 
-    def _on_disconnect(self, *args, **kwargs):
+    def _on_disconnect(self, client, userdata, rc):
         self._connected = False
+        self._connected_event.clear()
         if self.on_disconnect:
-            self.on_disconnect(*args, **kwargs)
+            self.on_disconnect(client, userdata, rc)
 
@@ -0,0 +1,123 @@
+import socket
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from iotcmqtt import mqttclient
+
+
+class StubClient:
+    ''' Stand-in for paho's Client recording the packets it would send, and
+    connecting immediately without any broker. Once hooked into an event loop
+    by the socket callbacks, the CONNACK is read from a socket pair instead
+    '''
+    instances = []
+
+    def __init__(self, client_id=None, **kwargs):
+        self.client_id = client_id
+        self.sent = []
+        self.will = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_socket_open = None
+        self.on_socket_close = None
+        self.on_socket_register_write = None
+        self.on_socket_unregister_write = None
+        # How the network loop was run, if paho would have run it
+        self.loop = None
+        # Number of reconnect() calls, and how many more of them should fail
+        self.reconnects = 0
+        self.reconnect_failures = 0
+        self._sock = None
+        self._peer = None
+        StubClient.instances.append(self)
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, qos, retain)
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def connect(self, host, port=1883, *args, **kwargs):
+        if self.on_socket_open:
+            self._sock, self._peer = socket.socketpair()
+            self._peer.send(b'connack')
+            self.on_socket_open(self, None, self._sock)
+
+    def reconnect(self):
+        self.reconnects += 1
+        if self.reconnect_failures:
+            self.reconnect_failures -= 1
+            raise ConnectionRefusedError('Connection refused')
+        self.connect(None)
+
+    def loop_read(self):
+        self._sock.recv(64)
+        self.on_connect(self, None, {}, 0)
+
+    def loop_misc(self):
+        if self._sock is None:
+            return mqtt.MQTT_ERR_NO_CONN
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        self.loop = 'thread'
+        self.on_connect(self, None, {}, 0)
+
+    def loop_forever(self):
+        self.loop = 'forever'
+        self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.drop(mqtt.MQTT_ERR_SUCCESS)
+
+    def drop(self, rc=mqtt.MQTT_ERR_CONN_LOST):
+        ''' Simulate the connection to the broker closing '''
+        if self._sock:
+            self.on_socket_close(self, None, self._sock)
+            self._sock.close()
+            self._peer.close()
+            self._sock = self._peer = None
+        self.on_disconnect(self, None, rc)
+
+    def subscribe(self, topic, qos=0):
+        subs = topic if isinstance(topic, list) else [(topic, qos)]
+        for _topic, sub_qos in subs:
+            if sub_qos not in (0, 1, 2):
+                raise ValueError('Invalid QoS level.')
+        self.sent.append(('subscribe', subs))
+        return mqtt.MQTT_ERR_SUCCESS, len(self.sent)
+
+    def unsubscribe(self, topic):
+        topics = topic if isinstance(topic, list) else [topic]
+        self.sent.append(('unsubscribe', topics))
+        return mqtt.MQTT_ERR_SUCCESS, len(self.sent)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.sent.append(('publish', topic, payload, qos, retain))
+
+    def deliver(self, topic, payload=b''):
+        ''' Simulate the broker sending a message to this client '''
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.on_message(self, None, message)
+
+    def subscriptions(self):
+        ''' Packets sent to subscribe or unsubscribe, in order '''
+        return [packet for packet in self.sent
+                if packet[0] in ('subscribe', 'unsubscribe')]
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    StubClient.instances = []
+    monkeypatch.setattr(mqttclient.mqtt, 'Client', StubClient)
+    yield StubClient
+    mqttclient._CLIENT_POOL.clear()
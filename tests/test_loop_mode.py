@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+import pytest
+
+from iotcmqtt import mqttclient
+from iotcmqtt.mqttclient import LoopMode, MqttClient
+
+
+async def wait_until(condition, timeout=2):
+    ''' Let the event loop run until condition is true '''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+def test_threaded_defaults_to_a_paho_thread(stub_client):
+    client = MqttClient(client_id='c')
+    assert client.loop_mode is LoopMode.THREAD and client.threaded
+    client.connect()
+    assert client.connected
+    assert stub_client.instances[0].loop == 'thread'
+
+
+def test_threaded_false_blocks_in_connect(stub_client):
+    client = MqttClient(client_id='c', threaded=False)
+    assert client.loop_mode is LoopMode.BLOCK and not client.threaded
+    client.connect()
+    assert stub_client.instances[0].loop == 'forever'
+
+
+def test_loop_mode_overrides_threaded(stub_client):
+    client = MqttClient(threaded=False, loop_mode='thread')
+    assert client.loop_mode is LoopMode.THREAD
+    with pytest.raises(ValueError):
+        MqttClient(loop_mode='fibers')
+
+
+def test_asyncio_falls_back_to_a_thread_without_an_event_loop(stub_client):
+    client = MqttClient(client_id='c', loop_mode='asyncio')
+    client.connect()
+    assert client.connected
+    assert client._shared.loop_mode is LoopMode.THREAD
+    assert stub_client.instances[0].loop == 'thread'
+
+
+def test_asyncio_connects_and_dispatches_on_the_event_loop(stub_client):
+    async def main():
+        received = []
+        client = MqttClient(client_id='c', loop_mode='asyncio')
+        client.connect()
+        stub = stub_client.instances[0]
+        assert stub.loop is None
+        assert await wait_until(lambda: client.connected)
+
+        client.subscribe(
+            't', lambda client, userdata, message: received.append(message))
+        stub.deliver('t', b'payload')
+        assert [message.payload for message in received] == [b'payload']
+
+        client.disconnect()
+        assert not client.connected
+
+    asyncio.run(main())
+
+
+def test_asyncio_reconnects_with_backoff(stub_client, monkeypatch):
+    monkeypatch.setattr(mqttclient, '_RECONNECT_DELAY_MIN', 0.01)
+    monkeypatch.setattr(mqttclient, '_RECONNECT_DELAY_MAX', 0.04)
+
+    async def main():
+        client = MqttClient(client_id='c', loop_mode='asyncio')
+        client.connect()
+        assert await wait_until(lambda: client.connected)
+        client.subscribe('t', print, 1)
+        stub = stub_client.instances[0]
+        shared = client._shared
+
+        delays = []
+        call_later = shared._loop.call_later
+
+        def record_call_later(delay, callback, *args):
+            if callback == shared._reconnect:
+                delays.append(delay)
+            return call_later(delay, callback, *args)
+
+        monkeypatch.setattr(shared._loop, 'call_later', record_call_later)
+
+        subscriptions = len(stub.subscriptions())
+        stub.reconnect_failures = 3
+        stub.drop()
+        assert not client.connected
+        assert await wait_until(lambda: client.connected)
+        assert stub.reconnects == 4
+        assert delays == [0.01, 0.02, 0.04, 0.04]
+        assert shared._reconnect_delay == 0.01
+        assert stub.subscriptions()[subscriptions:] == [
+            ('subscribe', [('t', 1)])]
+
+        client.disconnect()
+
+    asyncio.run(main())
+
+
+def test_asyncio_stops_reconnecting_on_disconnect(stub_client, monkeypatch):
+    monkeypatch.setattr(mqttclient, '_RECONNECT_DELAY_MIN', 0.01)
+
+    async def main():
+        client = MqttClient(client_id='c', loop_mode='asyncio')
+        client.connect()
+        assert await wait_until(lambda: client.connected)
+        stub = stub_client.instances[0]
+
+        stub.reconnect_failures = 100
+        stub.drop()
+        assert await wait_until(lambda: stub.reconnects)
+        client.disconnect()
+        reconnects = stub.reconnects
+        await asyncio.sleep(0.1)
+        assert stub.reconnects == reconnects
+        assert not client.connected
+
+    asyncio.run(main())
+
+
+def test_asyncio_runs_queued_callbacks_on_the_event_loop(stub_client):
+    async def main():
+        threads = []
+        client = MqttClient(
+            client_id='c', loop_mode='asyncio', queue_size=10)
+        client.connect()
+        assert isinstance(client._queue_worker, asyncio.Task)
+        assert await wait_until(lambda: client.connected)
+
+        client.subscribe(
+            't', lambda *args: threads.append(threading.get_ident()))
+        stub_client.instances[0].deliver('t')
+        assert not threads
+        assert await wait_until(lambda: threads)
+        assert threads == [threading.get_ident()]
+
+        worker = client._queue_worker
+        client.disconnect()
+        await asyncio.wait_for(worker, timeout=2)
+
+    asyncio.run(main())
@@ -0,0 +1,316 @@
+import threading
+import time
+
+import pytest
+
+from iotcmqtt import mqttclient
+from iotcmqtt.mqttclient import Message, MqttClient, get_mac_address
+
+
+def wait_for(condition, timeout=2):
+    ''' Wait for a worker thread to make condition true '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_subscribe_before_connect_raises(stub_client):
+    client = MqttClient(client_id='c')
+    with pytest.raises(ConnectionError):
+        client.subscribe('t', print)
+
+    client.connect()
+    client.subscribe('t', print)
+    assert stub_client.instances[0].subscriptions() == [
+        ('subscribe', [('t', 0)])]
+
+
+def test_failed_subscribe_is_not_kept(stub_client):
+    client = MqttClient(client_id='c')
+    client.connect()
+    with pytest.raises(ValueError):
+        client.subscribe('t', print, 5)
+
+    client.subscribe('t', print, 1)
+    assert stub_client.instances[0].subscriptions() == [
+        ('subscribe', [('t', 1)])]
+
+
+@pytest.mark.parametrize('topic_filter', ['a/#/b', 'a/b+', ''])
+def test_subscribe_rejects_invalid_filters(stub_client, topic_filter):
+    client = MqttClient(client_id='c')
+    client.connect()
+    with pytest.raises(ValueError):
+        client.subscribe(topic_filter, print)
+    with pytest.raises(ValueError):
+        client.subscribe(topic_filter, print, defer=True)
+
+    assert stub_client.instances[0].subscriptions() == []
+    assert not client._sub_trie
+
+
+def test_deferred_subscriptions_are_flushed_together(stub_client):
+    client = MqttClient(client_id='c')
+    client.subscribe('a', print, defer=True)
+    with pytest.raises(ValueError):
+        client.subscribe('b', print, 5, defer=True)
+    client.subscribe('c', print, 1, defer=True)
+
+    client.connect()
+    client.flush_subscriptions()
+    client.flush_subscriptions()
+    assert stub_client.instances[0].subscriptions() == [
+        ('subscribe', [('a', 0), ('c', 1)])]
+
+
+def test_resubscribe_after_reconnect(stub_client):
+    received = []
+    callback = lambda client, userdata, message: received.append(message)
+
+    client = MqttClient(client_id='c')
+    client.connect()
+    client.subscribe('a/+', callback)
+    client.disconnect()
+
+    client.connect()
+    client.subscribe('a/+', callback)
+    stub = stub_client.instances[-1]
+    assert stub.subscriptions() == [('subscribe', [('a/+', 0)])]
+
+    stub.deliver('a/b')
+    assert [message.topic for message in received] == ['a/b']
+
+
+def test_several_callbacks_share_a_subscription(stub_client):
+    received = []
+    first = lambda client, userdata, message: received.append('first')
+    second = lambda client, userdata, message: received.append('second')
+
+    client = MqttClient(client_id='c')
+    client.connect()
+    client.subscribe('t', first)
+    client.subscribe('t', second)
+    stub = stub_client.instances[0]
+    stub.deliver('t')
+    assert received == ['first', 'second']
+
+    client.unsubscribe('t', first)
+    assert stub.subscriptions() == [('subscribe', [('t', 0)])]
+    client.unsubscribe('t', second)
+    assert stub.subscriptions()[-1] == ('unsubscribe', ['t'])
+
+
+@pytest.mark.parametrize('capacity', [0, 1024])
+def test_resolve_cache_follows_subscription_changes(stub_client, capacity):
+    received = []
+    first = lambda client, userdata, message: received.append('first')
+    second = lambda client, userdata, message: received.append('second')
+
+    client = MqttClient(client_id='c').with_cache(capacity)
+    client.connect()
+    client.subscribe('a/+', first)
+    stub = stub_client.instances[0]
+    stub.deliver('a/b')
+    stub.deliver('a/b')
+    assert received == ['first', 'first']
+    assert client._resolve_cache.cache_info().currsize == min(capacity, 1)
+
+    client.subscribe('a/b', second)
+    stub.deliver('a/b')
+    assert sorted(received[2:]) == ['first', 'second']
+
+
+def test_shared_listeners_keep_the_highest_qos(stub_client):
+    first = MqttClient(client_id='c')
+    second = MqttClient(client_id='c')
+    first.connect()
+    second.connect()
+    assert len(stub_client.instances) == 1
+    stub = stub_client.instances[0]
+
+    first.subscribe('t', print, 2)
+    second.subscribe('t', print, 0)
+    assert stub.subscriptions() == [('subscribe', [('t', 2)])]
+
+    # Lowered to what the remaining listener needs once the QoS 2 one leaves
+    first.unsubscribe('t')
+    assert stub.subscriptions()[-1] == ('subscribe', [('t', 0)])
+
+    second.subscribe('t', print, 1)
+    first.subscribe('t', print, 2)
+    first.disconnect()
+    assert stub.subscriptions()[-3:] == [
+        ('subscribe', [('t', 1)]),
+        ('subscribe', [('t', 2)]),
+        ('subscribe', [('t', 1)])]
+
+    second.unsubscribe('t')
+    assert stub.subscriptions()[-1] == ('unsubscribe', ['t'])
+
+
+def test_shared_connection_requires_matching_settings(stub_client):
+    first = MqttClient(client_id='c')
+    first.connect()
+
+    second = MqttClient(client_id='c', will_message={'topic': 'will'})
+    with pytest.raises(ValueError, match='will_message'):
+        second.connect()
+    assert not second.connected
+
+    # A different client ID gets its own connection and will
+    second.client_id = 'd'
+    second.connect()
+    assert stub_client.instances[-1].will == ('will', None, 0, False)
+
+
+def test_shared_subscription_packets_keep_their_order(stub_client):
+    first = MqttClient(client_id='c')
+    second = MqttClient(client_id='c')
+    first.connect()
+    second.connect()
+    first.subscribe('t', print)
+    stub = stub_client.instances[0]
+
+    # The other listener subscribes while the UNSUBSCRIBE is being sent
+    racing = threading.Thread(target=second.subscribe, args=('t', print))
+    unsubscribe = stub.unsubscribe
+
+    def racing_unsubscribe(topic):
+        racing.start()
+        racing.join(timeout=0.1)
+        return unsubscribe(topic)
+
+    stub.unsubscribe = racing_unsubscribe
+    first.unsubscribe('t')
+    racing.join()
+    assert stub.subscriptions()[-2:] == [
+        ('unsubscribe', ['t']), ('subscribe', [('t', 0)])]
+
+
+
+def test_shared_connection_resubscribes_on_reconnect(stub_client):
+    first = MqttClient(client_id='c')
+    second = MqttClient(client_id='c')
+    first.connect()
+    second.connect()
+    first.subscribe('a', print, 2)
+    first.subscribe('b', print)
+    second.subscribe('a', print, 1)
+
+    stub = stub_client.instances[0]
+    stub.drop()
+    assert not first.connected
+    stub.on_connect(stub, None, {}, 0)
+    assert first.connected and second.connected
+    assert stub.subscriptions()[-1] == ('subscribe', [('a', 2), ('b', 0)])
+
+def test_default_birth_and_will_messages(stub_client):
+    client = MqttClient(client_id='c')
+    assert client.birth_message == Message(
+        'clients/c/connected', '1', 1, True)
+    assert client.will_message == Message(
+        'clients/c/connected', '0', 1, True)
+
+    client.connect()
+    stub = stub_client.instances[0]
+    assert stub.will == tuple(client.will_message)
+    assert stub.sent == [('publish', 'clients/c/connected', '1', 1, True)]
+
+
+def test_publish_after_blocking_connect_was_disconnected(stub_client):
+    client = MqttClient(
+        client_id='c', threaded=False,
+        on_connect=lambda *args: client.disconnect())
+    with pytest.raises(ConnectionError):
+        client.publish('t', 'payload')
+    with pytest.raises(ConnectionError):
+        client.publish_many([('t', 'payload')])
+
+
+
+@pytest.mark.parametrize('name', ['birth_message', 'will_message'])
+def test_messages_are_filled_with_defaults(name):
+    client = MqttClient(**{name: {'topic': 't', 'qos': 2}})
+    assert getattr(client, name) == Message('t', None, 2, False)
+
+    with pytest.raises(AttributeError, match=name):
+        MqttClient(**{name: {'payload': 'p'}})
+
+@pytest.mark.parametrize('node,expected', [
+    (0x0123456789ab, '01:23:45:67:89:ab'),
+    (0x1, '00:00:00:00:00:01'),
+])
+def test_get_mac_address(monkeypatch, node, expected):
+    monkeypatch.setattr(mqttclient.uuid, 'getnode', lambda: node)
+    assert get_mac_address() == expected
+
+
+
+def test_publish_forwards_qos_and_retain(stub_client):
+    client = MqttClient(client_id='c', birth_message={'topic': 'birth'})
+    client.publish('a', '1')
+    client.publish('b', '2', qos=2, retain=True)
+    assert stub_client.instances[0].sent[1:] == [
+        ('publish', 'a', '1', 0, False),
+        ('publish', 'b', '2', 2, True)]
+
+def test_publish_many_forwards_every_message(stub_client):
+    client = MqttClient(client_id='c', birth_message={'topic': 'birth'})
+    client.publish_many([('a', '1'), ('b', '2', 1), ('c', '3', 2, True)])
+    assert stub_client.instances[0].sent[1:] == [
+        ('publish', 'a', '1', 0, False),
+        ('publish', 'b', '2', 1, False),
+        ('publish', 'c', '3', 2, True)]
+
+
+def test_callback_errors_do_not_reach_other_listeners(stub_client, caplog):
+    received = []
+
+    def failing(client, userdata, message):
+        raise RuntimeError('callback failed')
+
+    first = MqttClient(client_id='c')
+    second = MqttClient(client_id='c')
+    first.connect()
+    second.connect()
+    first.subscribe('t', failing)
+    first.subscribe('t', lambda *args: received.append('first'))
+    second.subscribe('t', lambda *args: received.append('second'))
+
+    stub_client.instances[0].deliver('t')
+    assert received == ['first', 'second']
+    assert 'Error in callback for topic t' in caplog.text
+
+
+def test_queue_worker_survives_callback_errors(stub_client):
+    received = []
+
+    def callback(client, userdata, message):
+        if message.payload == b'bad':
+            raise RuntimeError('callback failed')
+        received.append(message.payload)
+
+    client = MqttClient(client_id='c', queue_size=10)
+    client.connect()
+    client.subscribe('t', callback)
+    stub = stub_client.instances[0]
+    stub.deliver('t', b'bad')
+    stub.deliver('t', b'good')
+
+    assert wait_for(lambda: received == [b'good'])
+    client.disconnect()
+
+
+def test_reconnecting_starts_a_new_queue_worker(stub_client):
+    client = MqttClient(client_id='c', queue_size=10)
+    client.connect()
+    old_worker = client._queue_worker
+    client.disconnect()
+
+    client.connect()
+    assert client._queue_worker is not old_worker
+    assert wait_for(lambda: not old_worker.is_alive())
+    client.disconnect()
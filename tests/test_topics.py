@@ -0,0 +1,79 @@
+import itertools
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from iotcmqtt.mqttclient import (
+    MAX_TOPIC_DEPTH, _match_topic, _split_topic, _trie_insert, _trie_remove,
+    _validate_filter)
+
+FILTERS = [
+    '#', '+', 'a', 'a/b', 'a/+', 'a/#', '+/b', '+/+', '+/#', 'a/b/c',
+    'a/+/c', '+/+/c', 'a/b/#', '/a', '/+', '+/', 'a//b', 'a/+/+/#',
+    '$SYS/#', '$SYS/+', '+/broker',
+]
+
+TOPICS = [
+    'a', 'b', 'a/b', 'a/c', 'b/b', 'a/b/c', 'a/x/c', 'x/y/c', 'a/b/c/d',
+    '/a', 'a/', 'a//b', '/', '$SYS/broker', '$SYS', 'x/broker',
+]
+
+
+@pytest.mark.parametrize(
+    'topic_filter,topic', list(itertools.product(FILTERS, TOPICS)))
+def test_match_topic_agrees_with_paho(topic_filter, topic):
+    trie = _trie_insert({}, _split_topic(topic_filter), (('callback',), 0))
+    matched = bool(_match_topic(trie, _split_topic(topic)))
+    assert matched == mqtt.topic_matches_sub(topic_filter, topic)
+
+
+def test_match_topic_collects_every_matching_subscription():
+    trie = {}
+    for topic_filter in FILTERS:
+        trie = _trie_insert(
+            trie, _split_topic(topic_filter), ((topic_filter,), 0))
+    for topic in TOPICS:
+        matched = {
+            callbacks[0]
+            for callbacks, _qos in _match_topic(trie, _split_topic(topic))}
+        assert matched == {
+            topic_filter for topic_filter in FILTERS
+            if mqtt.topic_matches_sub(topic_filter, topic)}
+
+
+def test_trie_updates_copy_the_path_and_prune_empty_nodes():
+    trie = _trie_insert({}, _split_topic('a/b'), (('first',), 0))
+    updated = _trie_insert(trie, _split_topic('a/c'), (('second',), 0))
+    assert 'c' not in trie['a']
+    assert updated['a']['b'] is trie['a']['b']
+
+    assert _trie_remove(updated, _split_topic('a/c')) == trie
+    assert _trie_remove(trie, _split_topic('a/b')) == {}
+    assert _trie_remove(trie, _split_topic('a')) is None
+
+
+def test_deep_topics_only_match_multi_level_wildcards():
+    topic = '/'.join(['l'] * (MAX_TOPIC_DEPTH + 1))
+    assert len(_split_topic(topic)) == MAX_TOPIC_DEPTH
+    for topic_filter, expected in [
+            ('/'.join(['l'] * (MAX_TOPIC_DEPTH - 1) + ['#']), True),
+            ('/'.join(['+'] * MAX_TOPIC_DEPTH), False),
+            ('/'.join(['l'] * MAX_TOPIC_DEPTH), False)]:
+        trie = _trie_insert({}, _split_topic(topic_filter), (('cb',), 0))
+        assert bool(_match_topic(trie, _split_topic(topic))) == expected
+
+
+@pytest.mark.parametrize('topic_filter', [
+    '', 'a/#/b', '#/a', 'a/b#', 'a+/b', 'a/+b', '##',
+    '/'.join(['a'] * (MAX_TOPIC_DEPTH + 1)),
+])
+def test_validate_filter_rejects_invalid_filters(topic_filter):
+    with pytest.raises(ValueError):
+        _validate_filter(topic_filter)
+
+
+@pytest.mark.parametrize('topic_filter', FILTERS + [
+    '/'.join(['+'] * MAX_TOPIC_DEPTH),
+])
+def test_validate_filter_accepts_valid_filters(topic_filter):
+    _validate_filter(topic_filter)